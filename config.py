@@ -10,6 +10,9 @@ N_T = 500
 # Dataset
 DATA_DIR = "AiresPucrs/chest-xray"
 # DATA_DIR = "dataset"
+# -1 picks it from the CPU and GPU count. Values above os.cpu_count() are capped (with a warning),
+# fewer workers are used if /dev/shm cannot hold their prefetched batches, and the datamodule
+# raises RuntimeError if /dev/shm cannot hold even one worker's (use 0 or enlarge /dev/shm)
 NUM_WORKERS = 8
 BATCH_SIZE = 64
 
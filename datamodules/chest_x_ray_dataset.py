@@ -1,36 +1,74 @@
+import os
+import shutil
+import warnings
+import numpy as np
 import torch
-from datasets import load_dataset
-import torchvision.transforms as transforms
+from torch import nn
+from datasets import load_dataset, Image as HFImage
+import torchvision.transforms.functional as TF
+from torchvision.io import decode_image, decode_jpeg, read_file, ImageReadMode
 import lightning as L
 from torch.utils.data import DataLoader, Dataset, Subset
-from torch.utils.data import random_split, ConcatDataset
+from torch.utils.data import random_split
 from torchvision.datasets import ImageFolder
 from sklearn.model_selection import train_test_split
+from tqdm import tqdm
+
+def encoded_image_to_tensor(image):
+    # HF image column with decode=False yields {'bytes': ..., 'path': ...}
+    if image['bytes'] is not None:
+        return torch.frombuffer(bytearray(image['bytes']), dtype=torch.uint8)
+    return read_file(image['path'])
+
+def load_grayscale_image(path):
+    # ImageFolder loader decoding with libjpeg-turbo into a (1, H, W) uint8 tensor
+    return decode_image(read_file(path), mode=ImageReadMode.GRAY)
+
+def cache_labels_path(cache_path):
+    return cache_path[:-len('.npy')] + '_labels.npy'
+
+def collate_encoded(batch):
+    # Encoded images differ in length, so they are kept as a list
+    images, labels = zip(*batch)
+    return list(images), torch.tensor(labels)
+
+class ResizeOrPad(nn.Module):
+    # Images smaller than the target are center padded, the rest are resized
+    def __init__(self, target_shape):
+        super().__init__()
+        self.target_shape = list(target_shape)
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        if image.shape[-2] < self.target_shape[0] and image.shape[-1] < self.target_shape[1]:
+            return TF.center_crop(image, self.target_shape)
+        return TF.resize(image, self.target_shape, antialias=True)
 
 class ChestXRayDataset(Dataset):
-    def __init__(self, dataset, target_shape, transform_resize=None, transform_padding=None):
-        self.dataset = dataset
-        self.transform_resize = transform_resize
-        self.transform_padding = transform_padding
-        self.target_shape = target_shape
+    def __init__(self, dataset, transform=None, decode=True, labels=None):
+        # Keep the encoded bytes and decode with torchvision.io instead of PIL
+        self.dataset = dataset.cast_column('image', HFImage(decode=False))
+        # Read the label column once, as a numpy array, instead of once per sample
+        self.labels = labels if labels is not None else np.asarray(dataset.with_format('numpy', columns=['label'])['label'])
+        self.transform = transform
+        self.decode = decode
         
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        image = self.dataset[idx]['image']
-        label = self.dataset[idx]['label']
-        if self.transform_resize and self.transform_padding:
-            if image.size[-2] < self.target_shape[0] and image.size[-1] < self.target_shape[1]:
-                image = self.transform_padding(image)
-            else:
-                image = self.transform_resize(image)
+        row = self.dataset[idx]
+        label = self.labels[idx]
+        if not self.decode:
+            return encoded_image_to_tensor(row['image']), label
+        image = decode_image(encoded_image_to_tensor(row['image']), mode=ImageReadMode.GRAY)
+        if self.transform:
+            image = self.transform(image)
         return image, label
 
 class ChestXRayDatasetPerLabel(ChestXRayDataset):
-    def __init__(self, dataset, label, transform=None):
-        super().__init__(dataset, transform)
-        self.indices = [i for i in range(len(dataset)) if dataset['label'][i] == label]
+    def __init__(self, dataset, label, transform=None, labels=None):
+        super().__init__(dataset, transform, labels=labels)
+        self.indices = np.where(np.asarray(self.labels) == label)[0].tolist()
 
     def __len__(self):
         return len(self.indices)
@@ -39,89 +77,284 @@ class ChestXRayDatasetPerLabel(ChestXRayDataset):
         real_idx = self.indices[idx]
         return super().__getitem__(real_idx)
 
+class CachedChestXRayDataset(Dataset):
+    # Reads pre-resized uint8 images from the (N, H, W) memmap built by ChestXRayDataModule
+    def __init__(self, cache_path, labels, indices):
+        self.cache_path = cache_path
+        self.labels = labels
+        self.indices = indices
+        self.images = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getstate__(self):
+        # A pickled memmap is a full in-memory copy, workers must remap the file instead
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            # Opened lazily so each worker maps the file instead of pickling it
+            self.images = np.load(self.cache_path, mmap_mode='r')
+        real_idx = self.indices[idx]
+        image = torch.from_numpy(np.array(self.images[real_idx])).unsqueeze(0)
+        return image, self.labels[real_idx]
+
+
+class MergedDataset(Dataset):
+    # Union of two datasets, one comparison per sample instead of ConcatDataset's bisect
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        self.offset = len(first)
+
+    def __len__(self):
+        return self.offset + len(self.second)
+
+    def __getitem__(self, idx):
+        if idx < self.offset:
+            return self.first[idx]
+        return self.second[idx - self.offset]
+
+
+class CUDAPrefetcher:
+    # Copies batch N+1 to the device on a side stream while batch N is being consumed
+    def __init__(self, dl, device, func=None):
+        self.dl = dl
+        self.device = device
+        self.func = func
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.dl)
+
+    def _preload(self, it):
+        batch = next(it, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            if self.func:
+                batch = self.func(batch)
+        return batch
+
+    def __iter__(self):
+        it = iter(self.dl)
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                # Memory allocated on the side stream must not be reused before the main stream is done
+                t.record_stream(current_stream)
+            next_batch = self._preload(it)
+            yield batch
+
 
 class ChestXRayDataModule(L.LightningDataModule):
     
-    def __init__(self, data_dir, batch_size, num_workers, mode='classification', device='cuda', seed=69, reduce_train="No"):
+    def __init__(self, data_dir, batch_size, num_workers, mode='classification', device='cuda', seed=69, reduce_train="No",
+                 persistent_workers=True, prefetch_factor=4, gpu_decode=True, cache_dir='cache',
+                 image_dtype=torch.float32):
         super().__init__()
         self.data_dir = data_dir
         self.batch_size = batch_size
-        self.num_workers = num_workers
         self.image_shape = (224, 224)
+        self.num_workers = self.resolve_num_workers(num_workers, prefetch_factor)
+        # Both options are only valid for multiprocess loading
+        self.persistent_workers = persistent_workers and self.num_workers > 0
+        self.prefetch_factor = prefetch_factor if self.num_workers > 0 else None
+        # Only applied once, when the image cache is built
+        self.transform = ResizeOrPad(self.image_shape)
         self.training_mode = mode
         self.device = device
+        self.pin_memory = torch.device(device).type == 'cuda'
+        # Decode the JPEGs with nvJPEG instead of in the workers when building the cache
+        self.gpu_decode = gpu_decode and torch.device(device).type == 'cuda'
         self.use_diffusion_sample = False
         self.reduce_train = reduce_train
         self.seed = seed
+        self.cache_dir = cache_dir
+        # dtype the uint8 batches are cast to on the device, e.g. torch.bfloat16 for mixed precision
+        self.image_dtype = image_dtype
+
+    def check_image_dtype(self):
+        # Reduced-precision inputs only match the model weights under the same trainer precision
+        precisions = {torch.bfloat16: ['bf16-mixed', 'bf16-true'], torch.float16: ['16-mixed', '16-true']}
+        if self.image_dtype == torch.float32:
+            return
+        trainer = self.trainer
+        if trainer is None or trainer.precision not in precisions.get(self.image_dtype, []):
+            precision = trainer.precision if trainer is not None else 'no trainer'
+            raise ValueError(f"image_dtype={self.image_dtype} requires a matching Trainer precision, got {precision}")
+
+    def resolve_num_workers(self, num_workers, prefetch_factor):
+        cpu_count = os.cpu_count() or 1
+        if num_workers < 0:
+            # Auto-tune: a few workers per GPU, bounded by the available cores
+            num_workers = min(cpu_count, 4 * torch.cuda.device_count() if torch.cuda.is_available() else 1)
+        elif num_workers > cpu_count:
+            warnings.warn(f"num_workers={num_workers} exceeds the {cpu_count} available CPUs, using {cpu_count}")
+            num_workers = cpu_count
+        if num_workers > 0 and os.path.isdir('/dev/shm'):
+            # Every worker keeps prefetch_factor uint8 batches in shared memory, DataLoader defaults to 2
+            worker_bytes = (prefetch_factor or 2) * self.batch_size * self.image_shape[0] * self.image_shape[1]
+            max_workers = shutil.disk_usage('/dev/shm').free // worker_bytes
+            if max_workers == 0:
+                raise RuntimeError(
+                    f"/dev/shm has room for no DataLoader worker ({worker_bytes} bytes needed), "
+                    "enlarge it or pass num_workers=0"
+                )
+            if max_workers < num_workers:
+                warnings.warn(f"/dev/shm only fits {max_workers} DataLoader workers, reducing num_workers from {num_workers}")
+                num_workers = max_workers
+        return num_workers
 
     def prepare_data(self) -> None:
         # download, IO, etc. Useful with shared filesystems
         # only called on 1 GPU/TPU in distributed
-        load_dataset(self.data_dir)
+        entire_dataset = load_dataset(self.data_dir, download_mode='reuse_dataset_if_exists')
+        # Every image is decoded and resized only once, all splits read from the same memmap
+        cache_path = self.image_cache_path(self.data_dir)
+        labels = np.asarray(entire_dataset['train'].with_format('numpy', columns=['label'])['label'])
+        if not self.cache_matches(cache_path, labels):
+            self.build_image_cache(
+                ChestXRayDataset(
+                    entire_dataset['train'],
+                    None if self.gpu_decode else self.transform,
+                    decode=not self.gpu_decode,
+                    labels=labels,
+                ),
+                cache_path,
+                collate_fn=collate_encoded if self.gpu_decode else None,
+            )
+        if self.reduce_train in ["Reduce to merge", "Use Sample Only", "Merge Only"]:
+            self.build_sampled_cache('classification_sample')
 
     def setup(self, stage):
         # make assignments here (val/train/test split)
         # called on every process in DDP
-        entire_dataset = load_dataset(self.data_dir)
-        entire_dataset['train']
+        self.check_image_dtype()
+        # Memory-maps the cache written by prepare_data, all splits come from this object
+        entire_dataset = load_dataset(self.data_dir, keep_in_memory=False)
         
-        # Transform to be used
-        transform_resize = transforms.Compose([
-            transforms.Grayscale(num_output_channels=1),
-            transforms.ToTensor(),
-            transforms.Resize((self.image_shape[0], self.image_shape[1])),
-        ])
-        transform_padding = transforms.Compose([
-            transforms.Grayscale(num_output_channels=1),
-            transforms.ToTensor(),
-            transforms.CenterCrop((self.image_shape[0], self.image_shape[1])),
-        ])
+        # Pre-resized images written by prepare_data
+        self.cache_path = self.image_cache_path(self.data_dir)
+        # Splits are computed once from the label column and index the cache directly
+        self.labels = np.asarray(entire_dataset['train'].with_format('numpy', columns=['label'])['label'])
+        if not self.cache_matches(self.cache_path, self.labels):
+            raise RuntimeError(
+                f"Image cache {self.cache_path} does not match {self.data_dir}, run prepare_data to rebuild it"
+            )
+        indices = np.arange(len(self.labels))
         
         # The split will be conducted as:
         # 50% for the diffusion model training
         # 30% for the classification model training
         # 10% for the classification model validation
         # 10% for the classification model testing
-        diffusion_classification_split = entire_dataset['train'].train_test_split(test_size=0.5, stratify_by_column='label', seed=self.seed)
-        diffusion_dataset = diffusion_classification_split['train']
-        classification_dataset = diffusion_classification_split['test']
-        
-        classification_train_test_split = classification_dataset.train_test_split(test_size=0.2, stratify_by_column='label', seed=self.seed)
-        train_dataset = classification_train_test_split['train']
-        test_dataset = classification_train_test_split['test']
-        
-        train_val_split = train_dataset.train_test_split(test_size=0.25, stratify_by_column='label', seed=self.seed)
-        train_dataset = train_val_split['train']
-        val_dataset = train_val_split['train']
+        diffusion_indices, classification_indices = self.stratified_split(indices, test_size=0.5)
+        train_indices, test_indices = self.stratified_split(classification_indices, test_size=0.2)
+        train_indices, val_indices = self.stratified_split(train_indices, test_size=0.25)
         if self.reduce_train == "Reduce":
-            train_dataset = train_dataset.train_test_split(test_size=0.25, stratify_by_column='label', seed=self.seed)['test']
-            self.train_dataset = ChestXRayDataset(train_dataset, self.image_shape, transform_resize, transform_padding)
+            train_indices = self.stratified_split(train_indices, test_size=0.25)[1]
+            self.train_dataset = self.cached_dataset(train_indices)
         if self.reduce_train == "Reduce to merge":
-            train_dataset = train_dataset.train_test_split(test_size=0.125, stratify_by_column='label', seed=self.seed)['test']
-            self.train_dataset = ChestXRayDataset(train_dataset, self.image_shape, transform_resize, transform_padding)
+            train_indices = self.stratified_split(train_indices, test_size=0.125)[1]
+            self.train_dataset = self.cached_dataset(train_indices)
             self.merge_original_sampled_datasets('classification_sample')
         elif self.reduce_train == "Use Sample Only":
             self.train_dataset = self.create_sampled_dataset('classification_sample')
         elif self.reduce_train == "Merge Only":
-            self.train_dataset = ChestXRayDataset(train_dataset, self.image_shape, transform_resize, transform_padding)
+            self.train_dataset = self.cached_dataset(train_indices)
             self.merge_original_sampled_datasets('classification_sample')
         else:
-            self.train_dataset = ChestXRayDataset(train_dataset, self.image_shape, transform_resize, transform_padding)
+            self.train_dataset = self.cached_dataset(train_indices)
 
-        self.diffusion_dataset = ChestXRayDataset(diffusion_dataset, self.image_shape, transform_resize, transform_padding)
-        self.val_dataset = ChestXRayDataset(val_dataset, self.image_shape, transform_resize, transform_padding)
-        self.test_dataset = ChestXRayDataset(test_dataset, self.image_shape, transform_resize, transform_padding)
+        self.diffusion_dataset = self.cached_dataset(diffusion_indices)
+        self.val_dataset = self.cached_dataset(val_indices)
+        self.test_dataset = self.cached_dataset(test_indices)
+    
+    def stratified_split(self, indices, test_size):
+        return train_test_split(indices, test_size=test_size, stratify=self.labels[indices], random_state=self.seed)
+    
+    def image_cache_path(self, source):
+        name = source.strip('/').replace('/', '__')
+        return os.path.join(self.cache_dir, f"{name}_{self.image_shape[0]}x{self.image_shape[1]}.npy")
+    
+    def cache_matches(self, cache_path, labels):
+        # Rows of the cache are paired with the dataset labels by position, so both must line up
+        labels_path = cache_labels_path(cache_path)
+        if not os.path.exists(cache_path) or not os.path.exists(labels_path):
+            return False
+        return np.array_equal(np.load(labels_path), labels)
+    
+    def build_image_cache(self, dataset, cache_path, collate_fn=None):
+        loader = DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            num_workers=self.num_workers,
+            shuffle=False,
+            collate_fn=collate_fn,
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # The labels file marks a complete cache, drop it until the new images are in place
+        if os.path.exists(cache_labels_path(cache_path)):
+            os.remove(cache_labels_path(cache_path))
+        # Written under a temporary name so an interrupted run never leaves a partial cache
+        tmp_path = cache_path + '.tmp'
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(dataset), *self.image_shape))
+        labels = np.empty(len(dataset), dtype=np.int64)
+        start = 0
+        for batch, batch_labels in tqdm(loader, desc="Caching images"):
+            if isinstance(batch, list):
+                batch = self.decode_on_device(batch, self.device)
+            images[start:start + len(batch)] = batch[:, 0].cpu().numpy()
+            labels[start:start + len(batch)] = batch_labels.numpy()
+            start += len(batch)
+        images.flush()
+        del images
+        os.replace(tmp_path, cache_path)
+        np.save(cache_labels_path(cache_path), labels)
+    
+    def build_sampled_cache(self, sampled_images_folder):
+        cache_path = self.image_cache_path(sampled_images_folder)
+        # Rebuilt whenever an image was added, removed (class folder mtime) or overwritten (file mtime)
+        newest_mtime = max(
+            os.path.getmtime(path)
+            for root, _, files in os.walk(sampled_images_folder)
+            for path in [root] + [os.path.join(root, name) for name in files]
+        )
+        # The labels file is written last, a missing one means the previous build did not finish
+        if (
+            not os.path.exists(cache_path)
+            or not os.path.exists(cache_labels_path(cache_path))
+            or os.path.getmtime(cache_path) < newest_mtime
+        ):
+            self.build_image_cache(
+                ImageFolder(root=sampled_images_folder, loader=load_grayscale_image, transform=self.transform),
+                cache_path,
+            )
+    
+    def cached_dataset(self, indices):
+        return CachedChestXRayDataset(self.cache_path, self.labels, indices)
     
     def create_sampled_dataset(self, sampled_images_folder):
-        transform_sample = transforms.Compose([
-            transforms.Grayscale(num_output_channels=1),
-            transforms.ToTensor(),
-        ])
-        return ImageFolder(root=sampled_images_folder, transform=transform_sample)
+        # Packed into the same uint8 memmap format as the HF images by prepare_data
+        cache_path = self.image_cache_path(sampled_images_folder)
+        if not os.path.exists(cache_path) or not os.path.exists(cache_labels_path(cache_path)):
+            raise RuntimeError(
+                f"Image cache {cache_path} for {sampled_images_folder} is missing or incomplete, run prepare_data to build it"
+            )
+        labels = np.load(cache_labels_path(cache_path))
+        return CachedChestXRayDataset(cache_path, labels, np.arange(len(labels)))
         
     def merge_original_sampled_datasets(self, sampled_images_folder):
         sampled_dataset = self.create_sampled_dataset(sampled_images_folder)
-        self.train_dataset = ConcatDataset([self.train_dataset, sampled_dataset])
+        self.train_dataset = MergedDataset(self.train_dataset, sampled_dataset)
     
     def set_training_mode(self, mode="classification"):
         if mode in ['classification', 'diffusion']:
@@ -134,6 +367,11 @@ class ChestXRayDataModule(L.LightningDataModule):
                 batch_size=self.batch_size,
                 num_workers=self.num_workers,
                 shuffle=True,
+                # Constant batch shape so cuDNN's autotuned algorithms stay valid
+                drop_last=True,
+                pin_memory=self.pin_memory,
+                persistent_workers=self.persistent_workers,
+                prefetch_factor=self.prefetch_factor,
             )
         else:
             return DataLoader(
@@ -141,6 +379,11 @@ class ChestXRayDataModule(L.LightningDataModule):
                 batch_size=self.batch_size,
                 num_workers=self.num_workers,
                 shuffle=True,
+                # Constant batch shape so cuDNN's autotuned algorithms stay valid
+                drop_last=True,
+                pin_memory=self.pin_memory,
+                persistent_workers=self.persistent_workers,
+                prefetch_factor=self.prefetch_factor,
             )
 
     def val_dataloader(self):
@@ -149,6 +392,9 @@ class ChestXRayDataModule(L.LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             shuffle=False,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
 
     def test_dataloader(self):
@@ -157,25 +403,46 @@ class ChestXRayDataModule(L.LightningDataModule):
             batch_size=self.batch_size,
             num_workers=self.num_workers,
             shuffle=False,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # Batches come from pinned memory, so the copy can overlap with compute
+        images, labels = batch
+        return images.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Batches travel as uint8 and are scaled to [0, 1] on the device in a single op
+        images, labels = batch
+        return TF.convert_image_dtype(images, self.image_dtype), labels
+
+    def decode_on_device(self, encoded_images, device):
+        # Encoded JPEGs stay on the host, nvJPEG decodes them into device memory.
+        # nvJPEG only reads JPEG, anything else (e.g. PNG) is decoded on the CPU and copied over
+        is_jpeg = [len(data) > 1 and data[0] == 0xFF and data[1] == 0xD8 for data in encoded_images]
+        jpegs = [data for data, jpeg in zip(encoded_images, is_jpeg) if jpeg]
+        decoded = iter(decode_jpeg(jpegs, mode=ImageReadMode.GRAY, device=device) if jpegs else [])
+        images = [
+            next(decoded) if jpeg else decode_image(data, mode=ImageReadMode.GRAY).to(device)
+            for data, jpeg in zip(encoded_images, is_jpeg)
+        ]
+        return torch.stack([self.transform(image) for image in images])
+
 # Dataset analysis functions (no training)
 
 def get_dataloader_from_hf(dataset_name, batch_size):
     dataset = load_dataset(dataset_name)
-    transform = transforms.Compose([
-        transforms.ToTensor()
-    ])
-    custom_dataset = ChestXRayDataset(dataset['train'], transform)
+    custom_dataset = ChestXRayDataset(dataset['train'])
     return DataLoader(custom_dataset, batch_size=batch_size, shuffle=True)
 
 def get_dataloaders_by_label(dataset_name, n_labels, batch_size):
     dataset = load_dataset(dataset_name)
-    transform = transforms.Compose([
-        transforms.ToTensor()
-    ])
+    # Shared by every per-label dataset instead of being re-read for each label
+    labels = np.asarray(dataset['train'].with_format('numpy', columns=['label'])['label'])
     dataloaders = []
     for i in range(n_labels):
-        custom_dataset = ChestXRayDatasetPerLabel(dataset['train'], i, transform)
+        custom_dataset = ChestXRayDatasetPerLabel(dataset['train'], i, labels=labels)
         dataloaders.append(DataLoader(custom_dataset, batch_size=batch_size, shuffle=True))
     return dataloaders
@@ -29,7 +29,7 @@ from generative.networks.schedulers import DDPMScheduler
 from generative.networks.nets import SPADEAutoencoderKL, SPADEDiffusionModelUNet
 
 from datasets import load_dataset # Hugging Face
-from datamodules.chest_x_ray_dataset import ChestXRayDataModule
+from datamodules.chest_x_ray_dataset import ChestXRayDataModule, CUDAPrefetcher
 import pdb
 import shutil
 from sklearn.model_selection import train_test_split as sk_train_test_split
@@ -139,6 +139,8 @@ def main():
     
     # Train
     
+    device = torch.device("cuda")
+
     datamodule = ChestXRayDataModule(
         data_dir=config.DATA_DIR,
         batch_size=config.BATCH_SIZE,
@@ -147,12 +149,15 @@ def main():
     datamodule.set_training_mode('diffusion')
     datamodule.prepare_data()
     datamodule.setup('fit')
-    diffusion_dataloader = datamodule.train_dataloader()
-    diffusion_val_dataloader = datamodule.val_dataloader()
+    # Overlaps the host to device copy of the next batch with the current step
+    to_float = partial(datamodule.on_after_batch_transfer, dataloader_idx=0)
+    diffusion_dataloader = CUDAPrefetcher(datamodule.train_dataloader(), device, to_float)
+    diffusion_val_dataloader = CUDAPrefetcher(datamodule.val_dataloader(), device, to_float)
 
     # ### Visualisation of the training images
     if True:
         check_data = first(diffusion_dataloader)
+        check_data = (check_data[0].cpu(), check_data[1].cpu())
         
         print(check_data[0][0].max())
         print(check_data[0][0].min())
@@ -174,8 +179,6 @@ def main():
     # the original DDPM scheduler containing 1000 timesteps in its Markov chain, and a 2D UNET with attention mechanisms
     # in the 2nd and 3rd levels, each with 1 attention head.
 
-    device = torch.device("cuda")
-
     model = DiffusionModelUNet(
         spatial_dims=2,
         in_channels=1,
@@ -226,8 +229,7 @@ def main():
             progress_bar.set_description(f"Epoch {epoch}")
             for step, batch in progress_bar:
                 torch.cuda.empty_cache()
-                images = batch[0].to(device)
-                labels = batch[1].to(device)
+                images, labels = batch
                 
                 optimizer.zero_grad(set_to_none=True)
 
@@ -271,8 +273,7 @@ def main():
                 model.eval()
                 val_epoch_loss = 0
                 for step, batch in enumerate(diffusion_val_dataloader):
-                    images = batch[0].to(device)
-                    labels = batch[1].to(device)
+                    images, labels = batch
                     with torch.no_grad():
                         with autocast(device_type="cuda", enabled=True):
                             noise = torch.randn_like(images).to(device)
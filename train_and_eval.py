@@ -31,6 +31,7 @@ def main():
         min_epochs=1,
         max_epochs=config.NUM_EPOCHS,
         precision=config.PRECISION,
+        benchmark=True,
         callbacks=[
             RichProgressBar(leave=True), 
             RichModelSummary(),
@@ -36,6 +36,7 @@ def main():
         min_epochs=1,
         max_epochs=config.NUM_EPOCHS,
         precision=config.PRECISION,
+        benchmark=True,
         logger=logger,
         log_every_n_steps=0,
         callbacks=[